@@ -44,6 +44,8 @@ class Field(db.Model):
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     products = db.relationship('FieldProduct', backref='field', lazy='dynamic')
     activities = db.relationship('Activity', backref='field', lazy='dynamic')
+    telemetry_chunks = db.relationship('TelemetryChunk', backref='field', lazy='dynamic')
+    telemetry_tokens = db.relationship('TelemetryToken', backref='field', lazy='dynamic')
     
     def __repr__(self):
         return f'<Field {self.name}>'
@@ -95,6 +97,41 @@ class Activity(db.Model):
     def __repr__(self):
         return f'<Activity {self.id} {self.activity_type.name}>'
 
+class TelemetryChunk(db.Model):
+    # One row holds a whole time block of readings for a single sensor/metric,
+    # packed as binary arrays (see telemetry.py for the layout)
+    __table_args__ = (
+        db.UniqueConstraint('field_id', 'sensor_id', 'metric', 'resolution', 'block_start',
+                            name='uq_telemetry_chunk'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    field_id = db.Column(db.Integer, db.ForeignKey('field.id'), nullable=False)  # leads uq_telemetry_chunk
+    sensor_id = db.Column(db.String(64), nullable=False)
+    metric = db.Column(db.String(32), nullable=False)  # soil_moisture, air_temperature, rainfall...
+    resolution = db.Column(db.String(8), nullable=False)  # raw, 1h, 1d
+    block_start = db.Column(db.BigInteger, nullable=False)  # Unix seconds (UTC)
+    sample_count = db.Column(db.Integer, default=0, nullable=False)
+    offsets = db.Column(db.LargeBinary)  # raw: seconds from block_start
+    values = db.Column(db.LargeBinary)  # raw: readings, rollups: per-slot sums
+    minimums = db.Column(db.LargeBinary)  # rollups only
+    maximums = db.Column(db.LargeBinary)  # rollups only
+    counts = db.Column(db.LargeBinary)  # rollups only
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<TelemetryChunk {self.field_id}:{self.sensor_id}:{self.metric} {self.resolution}@{self.block_start}>'
+
+class TelemetryToken(db.Model):
+    # Lets sensor probes post readings for one field without a user session
+    id = db.Column(db.Integer, primary_key=True)
+    field_id = db.Column(db.Integer, db.ForeignKey('field.id'), nullable=False, index=True)
+    token_hash = db.Column(db.String(64), unique=True, nullable=False)  # SHA-256 hex digest
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<TelemetryToken {self.field_id}>'
+
 # Add some predefined activity types
 def create_default_activity_types():
     default_types = [
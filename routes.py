@@ -6,7 +6,8 @@ from flask import render_template, redirect, url_for, flash, request, jsonify
 from flask_login import login_user, logout_user, current_user, login_required
 from urllib.parse import urlparse
 from app import db
-from models import User, Field, Product, FieldProduct, Activity, ActivityType, create_default_activity_types
+from models import User, Field, Product, FieldProduct, Activity, ActivityType, TelemetryChunk, TelemetryToken, create_default_activity_types
+from telemetry import ingest_readings, query_series, list_sensors, parse_timestamp, series_to_json, create_token, check_token, DAY, MAX_CLOCK_SKEW
 
 def register_routes(app):
     # Default activity types will be created after all routes are registered
@@ -180,6 +181,10 @@ def register_routes(app):
         # Delete associated activities
         Activity.query.filter_by(field_id=field.id).delete()
         
+        # Delete associated sensor telemetry
+        TelemetryChunk.query.filter_by(field_id=field.id).delete()
+        TelemetryToken.query.filter_by(field_id=field.id).delete()
+        
         db.session.delete(field)
         db.session.commit()
         
@@ -205,13 +210,97 @@ def register_routes(app):
         # Get field activities
         activities = Activity.query.filter_by(field_id=field.id).order_by(Activity.date.desc()).all()
         
+        # Get sensors reporting for this field (charts load data from field_telemetry)
+        sensors = list_sensors(field.id)
+        
         return render_template('fields/view.html', title=field.name, 
                               field=field, 
                               field_products=field_products,
                               products=products,
                               activities=activities,
+                              sensors=sensors,
                               os=os)
     
+    # Telemetry routes
+    def telemetry_access(field):
+        # Probes authenticate with the field's token, browsers with their session.
+        # Returns an error response, or None if access is allowed.
+        auth_header = request.headers.get('Authorization', '')
+        if auth_header.startswith('Bearer '):
+            if check_token(field.id, auth_header[len('Bearer '):].strip()):
+                return None
+            return jsonify({'error': 'Invalid telemetry token.'}), 401
+        
+        if not current_user.is_authenticated:
+            return jsonify({'error': 'Authentication required.'}), 401
+        
+        # Ensure the field belongs to the current user
+        if field.user_id != current_user.id:
+            return jsonify({'error': 'You do not have permission to access telemetry for this field.'}), 403
+        
+        return None
+    
+    @app.route('/fields/<int:id>/telemetry', methods=['POST'])
+    def ingest_telemetry(id):
+        field = Field.query.get_or_404(id)
+        
+        error = telemetry_access(field)
+        if error:
+            return error
+        
+        # Accept either {"readings": [...]} or a bare list of readings
+        payload = request.get_json(silent=True)
+        readings = payload.get('readings') if isinstance(payload, dict) else payload
+        
+        try:
+            stored = ingest_readings(field.id, readings)
+        except ValueError as e:
+            db.session.rollback()
+            return jsonify({'error': str(e)}), 400
+        
+        return jsonify({'received': len(readings), 'stored': stored})
+    
+    @app.route('/fields/<int:id>/telemetry', methods=['GET'])
+    def field_telemetry(id):
+        field = Field.query.get_or_404(id)
+        
+        error = telemetry_access(field)
+        if error:
+            return error
+        
+        metric = request.args.get('metric')
+        if not metric:
+            return jsonify({'error': 'A metric is required.'}), 400
+        
+        # Default to the last 24 hours, plus any readings ingest accepted from
+        # probes whose clocks run ahead
+        try:
+            now = parse_timestamp(datetime.utcnow())
+            end = parse_timestamp(request.args['end']) if request.args.get('end') else now + MAX_CLOCK_SKEW
+            start = parse_timestamp(request.args['start']) if request.args.get('start') else min(end, now) - DAY
+            series = query_series(field.id, metric, start, end,
+                                  sensor_id=request.args.get('sensor_id'),
+                                  resolution=request.args.get('resolution', 'auto'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        return jsonify(series_to_json(series))
+    
+    @app.route('/fields/<int:id>/telemetry/token', methods=['POST'])
+    @login_required
+    def create_telemetry_token(id):
+        field = Field.query.get_or_404(id)
+        
+        # Ensure the field belongs to the current user
+        if field.user_id != current_user.id:
+            flash('You do not have permission to manage sensors for this field.', 'danger')
+            return redirect(url_for('fields'))
+        
+        # The token is only stored hashed, so this is the one chance to copy it
+        token = create_token(field.id)
+        flash(f'New sensor token (copy it now, it will not be shown again; the previous token no longer works): {token}', 'success')
+        return redirect(url_for('view_field', id=field.id))
+    
     # Products routes
     @app.route('/products')
     @login_required
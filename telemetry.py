@@ -0,0 +1,390 @@
+import hashlib
+import secrets
+import sys
+import time
+from array import array
+from datetime import datetime, timezone
+from sqlalchemy.dialects import postgresql, sqlite
+from app import db
+from models import TelemetryChunk, TelemetryToken
+
+# Sensor readings are stored in time blocks rather than one row per reading.
+# A raw block keeps every sample as two packed arrays (offsets from the block
+# start and float64 values). Rollup blocks are dense: one slot per hour or day
+# holding the sum, count, minimum and maximum of the samples that fell into it,
+# so new readings can be merged in without re-reading the raw data.
+#
+# Blocks are kept small because every batch rewrites the blocks it touches: a
+# probe posting one reading a minute rewrites about 2.5 KB (one raw hour, one
+# day of hourly slots and 30 days of daily slots).
+#
+# Arrays are stored little-endian whatever the host byte order. Query results
+# are returned as array.array objects, which numpy.frombuffer() can wrap without
+# copying.
+
+assert array('I').itemsize == 4 and array('d').itemsize == 8
+
+HOUR = 3600
+DAY = 86400
+
+RAW = 'raw'
+RESOLUTIONS = {
+    # resolution: (slot length, block length) in seconds
+    RAW: (None, HOUR),
+    '1h': (HOUR, DAY),
+    '1d': (DAY, 30 * DAY),
+}
+ROLLUPS = ('1h', '1d')
+
+# Longest range a single query may ask for at each resolution
+MAX_SPANS = {
+    RAW: 2 * DAY,
+    '1h': 92 * DAY,
+}
+
+MAX_BATCH_SIZE = 10000
+MAX_ABS_VALUE = 1e12
+# Anything past year 9999 can't be a real reading and won't fit the database
+MAX_TIMESTAMP = 253402300799
+# Readings may be slightly ahead of the server clock, but not by more than this
+MAX_CLOCK_SKEW = DAY
+
+def parse_timestamp(value):
+    # Accepts Unix seconds (number or numeric string) or an ISO 8601 string;
+    # naive datetimes are treated as UTC
+    if isinstance(value, str):
+        try:
+            value = float(value)
+        except ValueError:
+            pass
+
+    if isinstance(value, bool):
+        raise ValueError(f'Invalid timestamp: {value!r}')
+    if isinstance(value, (int, float)):
+        # Compared without converting to float, so huge integers can't overflow;
+        # NaN and infinities fail the comparison too
+        if not 0 <= value <= MAX_TIMESTAMP:
+            raise ValueError(f'Invalid timestamp: {value!r}')
+        return int(value)
+
+    if isinstance(value, datetime):
+        moment = value
+    elif isinstance(value, str):
+        try:
+            moment = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            raise ValueError(f'Invalid timestamp: {value!r}')
+    else:
+        raise ValueError(f'Invalid timestamp: {value!r}')
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+
+    timestamp = int(moment.timestamp())
+    if not 0 <= timestamp <= MAX_TIMESTAMP:
+        raise ValueError(f'Invalid timestamp: {value!r}')
+    return timestamp
+
+def _block_start(timestamp, resolution):
+    block_length = RESOLUTIONS[resolution][1]
+    return timestamp - timestamp % block_length
+
+def _pack(values):
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+def _unpack(typecode, data):
+    values = array(typecode)
+    if data:
+        values.frombytes(data)
+        if sys.byteorder == 'big':
+            values.byteswap()
+    return values
+
+_INSERTS = {
+    'postgresql': postgresql.insert,
+    'sqlite': sqlite.insert,
+}
+
+def _get_chunk(field_id, sensor_id, metric, resolution, block_start):
+    key = dict(
+        field_id=field_id,
+        sensor_id=sensor_id,
+        metric=metric,
+        resolution=resolution,
+        block_start=block_start
+    )
+
+    # Make sure the row exists first, so that concurrent batches for a new block
+    # both end up waiting on the same row lock instead of racing to insert it
+    insert = _INSERTS[db.engine.dialect.name]
+    db.session.execute(
+        insert(TelemetryChunk).values(sample_count=0, **key).on_conflict_do_nothing(
+            index_elements=list(key)
+        )
+    )
+
+    return TelemetryChunk.query.filter_by(**key).with_for_update().populate_existing().one()
+
+def _merge_raw(chunk, samples):
+    # Merges time-sorted samples into a raw block and returns the ones that were
+    # new. A reading for a second that is already stored is a retried batch and
+    # is dropped, so retries don't count twice in the rollups.
+    offsets = _unpack('I', chunk.offsets)
+    values = _unpack('d', chunk.values)
+
+    stored = set(offsets)
+    new_samples = []
+    for timestamp, value in samples:
+        offset = timestamp - chunk.block_start
+        if offset not in stored:
+            stored.add(offset)
+            new_samples.append((timestamp, value))
+
+    if not new_samples:
+        return new_samples
+
+    # Only late readings need a full re-sort
+    in_order = not offsets or offsets[-1] < new_samples[0][0] - chunk.block_start
+    offsets.extend(timestamp - chunk.block_start for timestamp, _ in new_samples)
+    values.extend(value for _, value in new_samples)
+
+    if not in_order:
+        pairs = sorted(zip(offsets, values))
+        offsets = array('I', (offset for offset, _ in pairs))
+        values = array('d', (value for _, value in pairs))
+
+    chunk.offsets = _pack(offsets)
+    chunk.values = _pack(values)
+    chunk.sample_count = len(offsets)
+    return new_samples
+
+def _merge_rollup(chunk, samples):
+    slot_length, block_length = RESOLUTIONS[chunk.resolution]
+    slots = block_length // slot_length
+
+    if chunk.counts:
+        sums = _unpack('d', chunk.values)
+        minimums = _unpack('d', chunk.minimums)
+        maximums = _unpack('d', chunk.maximums)
+        counts = _unpack('I', chunk.counts)
+    else:
+        sums = array('d', [0.0]) * slots
+        minimums = array('d', [0.0]) * slots
+        maximums = array('d', [0.0]) * slots
+        counts = array('I', [0]) * slots
+
+    for timestamp, value in samples:
+        slot = (timestamp - chunk.block_start) // slot_length
+        if counts[slot] == 0:
+            minimums[slot] = value
+            maximums[slot] = value
+        else:
+            minimums[slot] = min(minimums[slot], value)
+            maximums[slot] = max(maximums[slot], value)
+        sums[slot] += value
+        counts[slot] += 1
+
+    chunk.values = _pack(sums)
+    chunk.minimums = _pack(minimums)
+    chunk.maximums = _pack(maximums)
+    chunk.counts = _pack(counts)
+    chunk.sample_count = (chunk.sample_count or 0) + len(samples)
+
+def _validate_reading(reading, latest):
+    if not isinstance(reading, dict):
+        raise ValueError('Each reading must be an object.')
+
+    sensor_id = reading.get('sensor_id')
+    metric = reading.get('metric')
+    if not isinstance(sensor_id, str) or not sensor_id or len(sensor_id) > 64:
+        raise ValueError(f'Invalid sensor_id: {sensor_id!r}')
+    if not isinstance(metric, str) or not metric or len(metric) > 32:
+        raise ValueError(f'Invalid metric: {metric!r}')
+
+    if 'timestamp' not in reading:
+        raise ValueError('Each reading needs a timestamp.')
+    timestamp = parse_timestamp(reading['timestamp'])
+    if timestamp > latest:
+        raise ValueError(f'Timestamp is in the future (expected Unix seconds): {reading["timestamp"]!r}')
+
+    value = reading.get('value')
+    if isinstance(value, bool) or not isinstance(value, (int, float)) \
+            or not -MAX_ABS_VALUE <= value <= MAX_ABS_VALUE:
+        raise ValueError(f'Invalid value: {value!r}')
+
+    return sensor_id, metric, timestamp, float(value)
+
+def ingest_readings(field_id, readings):
+    # Stores a batch of readings for one field and updates the hourly and daily
+    # rollups. Returns how many readings were new (retried readings are skipped).
+    # Raises ValueError (before writing anything) if a reading is invalid.
+    if not isinstance(readings, list):
+        raise ValueError('Readings must be a list.')
+    if len(readings) > MAX_BATCH_SIZE:
+        raise ValueError(f'At most {MAX_BATCH_SIZE} readings can be sent in one batch.')
+
+    latest = int(time.time()) + MAX_CLOCK_SKEW
+
+    # Group samples by the raw block they belong to, so each block is written once
+    raw_groups = {}
+    for reading in readings:
+        sensor_id, metric, timestamp, value = _validate_reading(reading, latest)
+        key = (sensor_id, metric, _block_start(timestamp, RAW))
+        raw_groups.setdefault(key, []).append((timestamp, value))
+
+    # Blocks are always locked raw first, then rollups, each in sorted key order,
+    # so overlapping batches can't deadlock
+    rollup_groups = {}
+    stored = 0
+    for key in sorted(raw_groups):
+        sensor_id, metric, block_start = key
+        samples = sorted(raw_groups[key])
+        new_samples = _merge_raw(_get_chunk(field_id, sensor_id, metric, RAW, block_start), samples)
+        stored += len(new_samples)
+        for timestamp, value in new_samples:
+            for resolution in ROLLUPS:
+                rollup_key = (sensor_id, metric, resolution, _block_start(timestamp, resolution))
+                rollup_groups.setdefault(rollup_key, []).append((timestamp, value))
+
+    for key in sorted(rollup_groups):
+        _merge_rollup(_get_chunk(field_id, *key), rollup_groups[key])
+
+    db.session.commit()
+    return stored
+
+def choose_resolution(start, end, sensor_id=None):
+    # Raw readings are only returned for a single sensor
+    span = end - start
+    if sensor_id and span <= MAX_SPANS[RAW]:
+        return RAW
+    if span <= MAX_SPANS['1h']:
+        return '1h'
+    return '1d'
+
+def _chunks_in_range(field_id, metric, resolution, start, end, sensor_id=None):
+    block_length = RESOLUTIONS[resolution][1]
+    query = TelemetryChunk.query.filter(
+        TelemetryChunk.field_id == field_id,
+        TelemetryChunk.metric == metric,
+        TelemetryChunk.resolution == resolution,
+        TelemetryChunk.block_start > start - block_length,
+        TelemetryChunk.block_start < end
+    )
+    if sensor_id:
+        query = query.filter(TelemetryChunk.sensor_id == sensor_id)
+    return query.order_by(TelemetryChunk.block_start).all()
+
+def query_series(field_id, metric, start, end, sensor_id=None, resolution='auto'):
+    # Returns readings in [start, end) as parallel arrays. Without a sensor_id,
+    # all sensors on the field reporting this metric are combined: each hourly
+    # or daily value is the mean of the per-sensor means, so a probe that
+    # reports more often doesn't outweigh the others.
+    start = parse_timestamp(start)
+    end = parse_timestamp(end)
+    if end <= start:
+        raise ValueError('End of the range must be after its start.')
+    if resolution == 'auto':
+        resolution = choose_resolution(start, end, sensor_id)
+    if resolution not in RESOLUTIONS:
+        raise ValueError(f'Unknown resolution: {resolution!r}')
+    if resolution == RAW and not sensor_id:
+        raise ValueError('Raw readings can only be queried for a single sensor.')
+    if resolution in MAX_SPANS and end - start > MAX_SPANS[resolution]:
+        raise ValueError(f'Ranges at {resolution} resolution are limited to {MAX_SPANS[resolution] // DAY} days.')
+
+    chunks = _chunks_in_range(field_id, metric, resolution, start, end, sensor_id)
+    if resolution == RAW:
+        points = _raw_points(chunks, start, end)
+    else:
+        points = _rollup_points(chunks, start, end)
+
+    return {
+        'metric': metric,
+        'sensor_id': sensor_id,
+        'resolution': resolution,
+        'start': start,
+        'end': end,
+        'timestamps': array('q', (point[0] for point in points)),
+        'values': array('d', (point[1] for point in points)),
+        'minimums': array('d', (point[2] for point in points)),
+        'maximums': array('d', (point[3] for point in points)),
+        'counts': array('I', (point[4] for point in points)),
+    }
+
+def _raw_points(chunks, start, end):
+    points = []
+    for chunk in chunks:
+        offsets = _unpack('I', chunk.offsets)
+        values = _unpack('d', chunk.values)
+        for offset, value in zip(offsets, values):
+            timestamp = chunk.block_start + offset
+            if start <= timestamp < end:
+                points.append((timestamp, value, value, value, 1))
+    return points
+
+def _rollup_points(chunks, start, end):
+    # Buckets are reported by their start; a bucket is included if it overlaps [start, end)
+    buckets = {}
+    for chunk in chunks:
+        slot_length = RESOLUTIONS[chunk.resolution][0]
+        sums = _unpack('d', chunk.values)
+        minimums = _unpack('d', chunk.minimums)
+        maximums = _unpack('d', chunk.maximums)
+        counts = _unpack('I', chunk.counts)
+
+        first_slot = max(0, (start - chunk.block_start) // slot_length)
+        last_slot = min(len(counts), -(-(end - chunk.block_start) // slot_length))
+        for slot in range(first_slot, last_slot):
+            if counts[slot] == 0:
+                continue
+            timestamp = chunk.block_start + slot * slot_length
+            mean = sums[slot] / counts[slot]
+            bucket = buckets.get(timestamp)
+            if bucket is None:
+                buckets[timestamp] = [[mean], counts[slot], minimums[slot], maximums[slot]]
+            else:
+                bucket[0].append(mean)
+                bucket[1] += counts[slot]
+                bucket[2] = min(bucket[2], minimums[slot])
+                bucket[3] = max(bucket[3], maximums[slot])
+
+    return [
+        (timestamp, sum(means) / len(means), minimum, maximum, count)
+        for timestamp, (means, count, minimum, maximum) in sorted(buckets.items())
+    ]
+
+def list_sensors(field_id):
+    # Distinct (sensor_id, metric) pairs that have reported for this field
+    rows = db.session.query(TelemetryChunk.sensor_id, TelemetryChunk.metric).filter(
+        TelemetryChunk.field_id == field_id,
+        TelemetryChunk.resolution == '1d'
+    ).distinct().order_by(TelemetryChunk.sensor_id, TelemetryChunk.metric).all()
+    return [(sensor_id, metric) for sensor_id, metric in rows]
+
+def series_to_json(series):
+    # Plain lists for jsonify; the arrays themselves can go straight to numpy
+    return {
+        key: value.tolist() if isinstance(value, array) else value
+        for key, value in series.items()
+    }
+
+def _hash_token(token):
+    # Tokens are long random strings, so a plain SHA-256 is enough to store them
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def create_token(field_id):
+    # Issues a new probe token for the field, revoking the previous one.
+    # Only the hash is stored, so the token can be shown to the user once.
+    TelemetryToken.query.filter_by(field_id=field_id).delete()
+    token = secrets.token_urlsafe(32)
+    db.session.add(TelemetryToken(field_id=field_id, token_hash=_hash_token(token)))
+    db.session.commit()
+    return token
+
+def check_token(field_id, token):
+    return TelemetryToken.query.filter_by(
+        field_id=field_id,
+        token_hash=_hash_token(token)
+    ).first() is not None
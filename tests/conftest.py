@@ -0,0 +1,32 @@
+import os
+
+import pytest
+
+# Must be set before the app module creates its engine
+os.environ['DATABASE_URL'] = 'sqlite://'
+
+from app import app as flask_app, db
+from models import User, Field
+
+
+@pytest.fixture
+def app():
+    flask_app.config['TESTING'] = True
+    with flask_app.app_context():
+        db.create_all()
+        yield flask_app
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def field(app):
+    user = User(username='farmer', email='farmer@example.com')
+    user.set_password('secret')
+    db.session.add(user)
+    db.session.commit()
+
+    field = Field(name='North field', user_id=user.id)
+    db.session.add(field)
+    db.session.commit()
+    return field
@@ -0,0 +1,167 @@
+import json
+import struct
+import time
+
+import pytest
+
+from models import TelemetryChunk
+from telemetry import DAY, HOUR, check_token, create_token, ingest_readings, parse_timestamp, query_series
+
+# Start of a UTC day (2023-11-14)
+DAY_START = 1699920000
+
+
+def reading(timestamp, value, sensor_id='probe-1', metric='soil_moisture'):
+    return {'sensor_id': sensor_id, 'metric': metric, 'timestamp': timestamp, 'value': value}
+
+
+def test_out_of_order_batches_are_merged_in_time_order(field):
+    readings = [reading(DAY_START + i * 60, float(i)) for i in range(60)]
+    ingest_readings(field.id, readings[30:])
+    ingest_readings(field.id, readings[:30])
+
+    series = query_series(field.id, 'soil_moisture', DAY_START, DAY_START + HOUR, sensor_id='probe-1')
+
+    assert series['resolution'] == 'raw'
+    assert series['timestamps'].tolist() == [DAY_START + i * 60 for i in range(60)]
+    assert series['values'].tolist() == [float(i) for i in range(60)]
+
+
+def test_retried_batch_is_not_counted_twice(field):
+    readings = [reading(DAY_START + i * 60, 10.0 + i) for i in range(5)]
+    assert ingest_readings(field.id, readings) == 5
+    assert ingest_readings(field.id, readings) == 0
+
+    raw = query_series(field.id, 'soil_moisture', DAY_START, DAY_START + HOUR, sensor_id='probe-1')
+    hourly = query_series(field.id, 'soil_moisture', DAY_START, DAY_START + HOUR,
+                          sensor_id='probe-1', resolution='1h')
+
+    assert len(raw['values']) == 5
+    assert hourly['counts'].tolist() == [5]
+    assert hourly['values'].tolist() == [12.0]
+
+
+def test_rollup_slots_at_block_boundaries(field):
+    # Last hour of one day block and first hour of the next
+    ingest_readings(field.id, [
+        reading(DAY_START + DAY - HOUR, 1.0),
+        reading(DAY_START + DAY - 1, 3.0),
+        reading(DAY_START + DAY, 5.0),
+        reading(DAY_START + DAY + HOUR, 7.0),
+    ])
+
+    # A range starting mid-slot includes that slot; one ending on a slot boundary excludes the next
+    series = query_series(field.id, 'soil_moisture', DAY_START + DAY - 60, DAY_START + DAY + HOUR,
+                          sensor_id='probe-1', resolution='1h')
+
+    assert series['timestamps'].tolist() == [DAY_START + DAY - HOUR, DAY_START + DAY]
+    assert series['values'].tolist() == [2.0, 5.0]
+    assert series['minimums'].tolist() == [1.0, 5.0]
+    assert series['maximums'].tolist() == [3.0, 5.0]
+    assert series['counts'].tolist() == [2, 1]
+
+
+def test_sensors_are_combined_as_mean_of_sensor_means(field):
+    ingest_readings(field.id, [reading(DAY_START + i * 60, float(i), sensor_id='s1') for i in range(60)])
+    ingest_readings(field.id, [reading(DAY_START + i * 360, 100.0, sensor_id='s2') for i in range(10)])
+
+    series = query_series(field.id, 'soil_moisture', DAY_START, DAY_START + DAY)
+
+    assert series['resolution'] == '1h'
+    assert series['values'].tolist() == [(29.5 + 100.0) / 2]
+    assert series['minimums'].tolist() == [0.0]
+    assert series['maximums'].tolist() == [100.0]
+    assert series['counts'].tolist() == [70]
+
+    with pytest.raises(ValueError):
+        query_series(field.id, 'soil_moisture', DAY_START, DAY_START + DAY, resolution='raw')
+
+
+@pytest.mark.parametrize('bad', [
+    reading(1e19, 1.0),
+    reading(10 ** 400, 1.0),
+    reading(str(10 ** 400), 1.0),
+    reading(1.7e12, 1.0),
+    reading(4102444800, 1.0),  # 2100
+    reading(-1, 1.0),
+    reading('yesterday', 1.0),
+    reading(DAY_START, float('inf')),
+    reading(DAY_START, float('nan')),
+    reading(DAY_START, 1e300),
+    reading(DAY_START, 10 ** 400),
+    reading(DAY_START, True),
+    reading(DAY_START, '12'),
+    reading(DAY_START, 1.0, sensor_id=''),
+    reading(DAY_START, 1.0, metric='x' * 33),
+    {'sensor_id': 'probe-1', 'metric': 'soil_moisture', 'value': 1.0},
+])
+def test_bad_readings_are_rejected_without_writing(field, bad):
+    with pytest.raises(ValueError):
+        ingest_readings(field.id, [reading(DAY_START, 1.0), bad])
+
+    assert TelemetryChunk.query.count() == 0
+
+
+def test_parse_timestamp_accepts_numeric_strings():
+    assert parse_timestamp('1700000000') == 1700000000
+    assert parse_timestamp('2023-11-14T00:00:00Z') == DAY_START
+
+
+def test_raw_queries_are_limited_in_span(field):
+    with pytest.raises(ValueError):
+        query_series(field.id, 'soil_moisture', DAY_START, DAY_START + 30 * DAY,
+                     sensor_id='probe-1', resolution='raw')
+
+
+def test_blobs_are_little_endian(field):
+    ingest_readings(field.id, [reading(DAY_START + 5, 0.25)])
+
+    chunk = TelemetryChunk.query.filter_by(resolution='raw').one()
+    assert chunk.offsets == struct.pack('<I', 5)
+    assert chunk.values == struct.pack('<d', 0.25)
+
+
+def test_probe_token_authenticates_ingest(app, field):
+    client = app.test_client()
+    url = f'/fields/{field.id}/telemetry'
+    payload = {'readings': [reading(DAY_START, 1.0)]}
+
+    response = client.post(url, json=payload)
+    assert response.status_code == 401
+    assert response.is_json
+
+    response = client.post(url, json=payload, headers={'Authorization': 'Bearer wrong'})
+    assert response.status_code == 401
+
+    token = create_token(field.id)
+    response = client.post(url, json=payload, headers={'Authorization': f'Bearer {token}'})
+    assert response.status_code == 200
+    assert response.get_json() == {'received': 1, 'stored': 1}
+
+    # Issuing a new token revokes the old one
+    create_token(field.id)
+    assert not check_token(field.id, token)
+
+
+def test_default_window_includes_latest_reading(app, field):
+    client = app.test_client()
+    token = create_token(field.id)
+    headers = {'Authorization': f'Bearer {token}'}
+    url = f'/fields/{field.id}/telemetry'
+    now = int(time.time())
+
+    client.post(url, json=[reading(now, 42.0)], headers=headers)
+
+    response = client.get(f'{url}?metric=soil_moisture&sensor_id=probe-1', headers=headers)
+    assert response.status_code == 200
+    assert response.get_json()['timestamps'] == [now]
+
+
+def test_huge_integers_are_a_bad_request(app, field):
+    client = app.test_client()
+    headers = {'Authorization': f'Bearer {create_token(field.id)}'}
+    url = f'/fields/{field.id}/telemetry'
+
+    for bad in (reading(10 ** 400, 1), reading(DAY_START, 10 ** 400)):
+        response = client.post(url, data=json.dumps([bad]), content_type='application/json', headers=headers)
+        assert response.status_code == 400